@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from vlgp import core
+from vlgp.gp import make_cholesky
+from vlgp.preprocess import get_config, get_params, initialize, fill_params, fill_trials
+from vlgp.util import cut_trials
+
+
+def segments_of(ntrial=8, length=100, ydim=10, zdim=2, **kwargs):
+    np.random.seed(0)
+    a = np.random.randn(zdim, ydim)
+    t = np.linspace(0, 8 * np.pi, length)
+    z = np.column_stack((np.sin(t), np.cos(t)))[:, :zdim]
+    trials = [{"y": np.random.poisson(np.exp(z @ a - 1))} for _ in range(ntrial)]
+
+    config = get_config(**kwargs)
+    params = get_params(trials, zdim, omega_bound=config["omega_bound"], **kwargs)
+    initialize(trials, params, config)
+    fill_params(params)
+    fill_trials(trials)
+    make_cholesky(trials, params, config)
+    core.update_w(trials, params, config)
+    core.update_v(trials, params, config)
+
+    segments = cut_trials(trials, params, config)
+    make_cholesky(segments, params, config)
+    fill_trials(segments)
+    return segments, params, config
+
+
+@pytest.fixture
+def make_segments():
+    """Segments, parameters and config of simulated trials, make_segments(**config)"""
+    return segments_of
@@ -8,3 +8,26 @@ def test_save_load(tmp_path):
 
     model2 = VLGP.load(file)
     assert model1 == model2
+
+
+def test_infer():
+    import numpy as np
+
+    np.random.seed(0)
+    t = np.linspace(0, 8 * np.pi, 100)
+    z = np.column_stack((np.sin(t), np.cos(t)))
+    a = np.random.randn(2, 10)
+    trials = [{"y": np.random.poisson(np.exp(z @ a - 1))} for _ in range(4)]
+
+    model = VLGP(n_factors=2)
+    model.fit(trials, max_iter=2, min_iter=2)
+    new = [
+        {"y": np.random.poisson(np.exp(z[:length] @ a - 1))}
+        for length in (100, 60, 100)
+    ]
+    serial = model.infer([dict(trial) for trial in new], batch=0)
+    batch = model.infer(new)
+    for s, b in zip(serial, batch):
+        assert b["mu"].shape == (b["y"].shape[0], 2)
+        assert np.allclose(s["mu"], b["mu"])
+        assert np.allclose(s["v"], b["v"])
@@ -0,0 +1,485 @@
+import copy
+
+import numpy as np
+
+from vlgp import core
+from vlgp.gp import make_cholesky
+from vlgp.preprocess import fill_trials
+from vlgp.trialset import TrialSet
+from vlgp.util import concat_trials, stack_trials
+
+
+def copy_trials(trials):
+    return [
+        {k: np.copy(v) if isinstance(v, np.ndarray) else v for k, v in trial.items()}
+        for trial in trials
+    ]
+
+
+def assert_same_posterior(a, b):
+    for s, t in zip(a, b):
+        for key in ("mu", "w", "v", "dmu"):
+            assert np.allclose(s[key], t[key])
+
+
+def test_single_trial(make_segments):
+    # eta and the rate recomputed from scratch at every step
+    segments, params, config = make_segments(Eniter=3, tol=0)
+    params = dict(params, precision={})
+    a, b = params["a"], params["b"]
+    trial = copy_trials(segments[:1])[0]
+    assert core.infer_single_trial(trial, params, config) == 3
+
+    mu, w, v = (segments[0][key].copy() for key in ("mu", "w", "v"))
+    xb = np.einsum("ijk, jk -> ik", segments[0]["x"], b)
+    for _ in range(3):
+        r = np.exp(mu @ a + xb + 0.5 * v @ a ** 2)
+        p = (segments[0]["y"] - r) @ a.T
+        dmu = np.empty_like(mu)
+        for l, G in enumerate(params["cholesky"][mu.shape[0]]):
+            K = G @ G.T
+            u = K @ p[:, l] - mu[:, l]
+            step = np.linalg.solve(np.identity(K.shape[0]) + K * w[:, l], u)
+            dmu[:, l] = np.clip(step, -config["dmu_bound"], config["dmu_bound"])
+        mu += dmu
+        r = np.exp(mu @ a + xb + 0.5 * v @ a ** 2)
+        w = r @ a.T ** 2
+        for l, G in enumerate(params["cholesky"][mu.shape[0]]):
+            K = G @ G.T
+            v[:, l] = np.diag(K - K @ np.linalg.solve(np.diag(1 / w[:, l]) + K, K))
+
+    for key, value in (("mu", mu), ("w", w), ("v", v), ("dmu", dmu)):
+        assert np.allclose(trial[key], value)
+
+
+def test_parallel_estep(make_segments):
+    segments, params, config = make_segments(Eniter=3)
+    serial = copy_trials(segments)
+    core.estep(serial, params, config)
+
+    config["parallel"] = 2
+    core.estep(segments, params, config)
+
+    assert_same_posterior(serial, segments)
+
+
+def test_parallel_vem(make_segments):
+    segments, params, config = make_segments(Eniter=2, Mniter=2, max_iter=2, parallel=2)
+    mu = [segment["mu"] for segment in segments]
+    core.vem(segments, params, config)
+    # results are written back into the original arrays
+    assert all(segment["mu"] is m for segment, m in zip(segments, mu))
+    assert all(np.all(np.isfinite(segment["mu"])) for segment in segments)
+
+
+def test_vem_trialset(make_segments, monkeypatch):
+    from vlgp import gp
+
+    # the M and H steps read the buffers of the segments
+    seen = []
+
+    def spy(f):
+        def wrapper(trials, *args, **kwargs):
+            seen.append(
+                isinstance(trials, TrialSet)
+                and all(
+                    np.shares_memory(concat_trials(trials, key), trials[0][key])
+                    for key in ("y", "x", "mu", "v")
+                )
+                and np.shares_memory(stack_trials(trials, "w"), trials[0]["w"])
+            )
+            return f(trials, *args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(core, "mstep", spy(core.mstep))
+    monkeypatch.setattr(gp, "optimize", spy(gp.optimize))
+    for parallel in (False, 2):
+        segments, params, config = make_segments(
+            Eniter=2, Mniter=1, max_iter=2, parallel=parallel
+        )
+        seen.clear()
+        core.vem(segments, params, config)
+        assert len(seen) > 2 and all(seen)  # the M and H steps of two iterations
+
+
+def test_vem_blend(make_segments):
+    segments, params, config = make_segments(
+        length=130, Eniter=2, Mniter=1, max_iter=2, constrain_latent="both"
+    )
+    assert any(segment["overlap"] for segment in segments)
+    core.vem(segments, params, config)
+    for segment in segments:
+        s = np.s_[segment["start"] : segment["start"] + segment["y"].shape[0]]
+        assert np.allclose(segment["mu"], segment["parent"]["mu"][s])
+
+
+def test_batch_estep(make_segments):
+    # exact priors of short windows and low-rank priors of long ones
+    for window in (20, 50, 80):
+        segments, params, config = make_segments(Eniter=3, window=window)
+        serial = copy_trials(segments)
+        core.estep(serial, params, config)
+
+        for size in (1, 5, True):  # 5 leaves a partial stack
+            batch = copy_trials(segments)
+            core.estep(batch, params, dict(config, batch=size))
+            assert_same_posterior(serial, batch)
+
+
+def test_kernel_estep(make_segments):
+    # the windows are no longer than the rank, the exact prior is solved directly
+    segments, params, config = make_segments(Eniter=3)
+    assert segments[0]["y"].shape[0] in params["precision"]
+    direct = copy_trials(segments)
+    woodbury = copy_trials(segments)
+    core.estep(direct, params, config)
+    core.estep(woodbury, dict(params, precision={}), config)
+
+    assert_same_posterior(direct, woodbury)
+
+
+def test_adaptive_rank(make_segments):
+    segments, params, config = make_segments(Eniter=3, rank_tol=1e-6)
+    params["omega"] = np.array([5e-4, 5e-2])
+    make_cholesky(segments, params, config)
+    window = config["window"]
+    slow, fast = params["cholesky"][window]
+    assert slow.shape[1] < window // 2  # low rank
+    assert fast.shape == (window, window)  # exact
+    assert params["precision"][window][0] is None
+
+    serial = copy_trials(segments)
+    core.estep(serial, params, config)
+    config["batch"] = 10
+    config["parallel"] = 2
+    core.estep(segments, params, config)
+    assert_same_posterior(serial, segments)
+
+
+def test_joint_estep(make_segments):
+    segments, params, config = make_segments(Eniter=3, rank_tol=1e-6)
+    # one low-rank and one exact latent, the low-rank block first in either order
+    for omega in ([5e-4, 5e-2], [5e-2, 5e-4]):
+        params["omega"] = np.array(omega)
+        make_cholesky(segments, params, config)
+        for p in (params, dict(params, precision={})):
+            serial = copy_trials(segments)
+            core.estep(serial, p, config)
+            for batch in (0, 5):
+                joint = copy_trials(segments)
+                core.estep(joint, p, dict(config, joint=True, batch=batch))
+                assert_same_posterior(serial, joint)
+
+
+def test_estep_early_stop(make_segments):
+    segments, params, config = make_segments(Eniter=25, tol=1e-3)
+    serial = copy_trials(segments)
+    niter = core.estep(serial, params, config)
+    assert niter.shape == (len(segments),)
+    assert np.all(niter < 25)
+
+    for options in ({"batch": 5}, {"batch": 5, "joint": True}, {"parallel": 2}):
+        trials = copy_trials(segments)
+        assert np.array_equal(
+            core.estep(trials, params, dict(config, **options)), niter
+        )
+        assert_same_posterior(serial, trials)
+
+
+def test_active_set(make_segments):
+    # a loose tolerance makes trials stationary after one step
+    segments, params, config = make_segments(
+        Eniter=5, Mniter=2, max_iter=4, min_iter=4, tol=1.0, Erecheck=3
+    )
+    core.vem(segments, params, config)
+    runtime = config["runtime"]
+    assert runtime["e_active"][0] == len(segments)
+    assert runtime["e_active"][1] < len(segments)
+    assert runtime["e_active"][3] == len(segments)  # re-checked
+    assert len(runtime["e_niter"]) == 4
+
+
+def test_newton_step():
+    np.random.seed(0)
+    A = np.random.randn(4, 3, 3)
+    nhess = A @ np.swapaxes(A, 1, 2)
+    nhess[2] = -np.eye(3)  # not positive definite
+    grad = np.random.randn(4, 3)
+    step = core.newton_step(nhess, grad, 0.0, 0.5)
+    for n in (0, 1, 3):
+        assert np.allclose(step[n], np.linalg.solve(nhess[n], grad[n]))
+    assert np.allclose(step[2], 0.5 * grad[2])
+
+
+def test_weighted_moments():
+    np.random.seed(0)
+    r = np.random.rand(10, 4)
+    p = np.random.randn(10, 3)
+    q = np.random.randn(10, 2)
+    moments = core.weighted_moments(r, p, q, block=3)
+    assert np.allclose(moments, np.einsum("tn, ti, tj -> nij", r, p, q))
+
+
+def test_poisson_mstep(make_segments):
+    # one Newton step of every neuron, by the explicit formulas of each
+    segments, params, config = make_segments(Mniter=1, da_bound=1e6, db_bound=1e6)
+    a = params["a"].copy()
+    b = params["b"].copy()
+    core.mstep(segments, params, config)
+
+    y = np.concatenate([s["y"] for s in segments])
+    x = np.concatenate([s["x"] for s in segments])
+    mu = np.concatenate([s["mu"] for s in segments])
+    v = np.concatenate([s["v"] for s in segments])
+    r = np.exp(mu @ a + np.einsum("ijk, jk -> ik", x, b) + 0.5 * v @ a ** 2)
+    eps = config["eps"]
+    for n in range(params["ydim"]):
+        m = mu + v * a[:, n]
+        grad_a = mu.T @ y[:, n] - m.T @ r[:, n]
+        nhess_a = m.T @ (r[:, n, np.newaxis] * m) + np.diag(r[:, n] @ v)
+        nhess_a += eps * np.identity(params["zdim"])
+        assert np.allclose(
+            params["a"][:, n], a[:, n] + np.linalg.solve(nhess_a, grad_a)
+        )
+
+        grad_b = x[..., n].T @ (y[:, n] - r[:, n])
+        nhess_b = x[..., n].T @ (r[:, n, np.newaxis] * x[..., n])
+        nhess_b += eps * np.identity(params["xdim"])
+        assert np.allclose(
+            params["b"][:, n], b[:, n] + np.linalg.solve(nhess_b, grad_b)
+        )
+
+
+def test_gaussian_mstep(make_segments):
+    segments, params, config = make_segments(Mniter=1)
+    likelihood = params["likelihood"].astype(object)
+    likelihood[::2] = "gaussian"
+    params["likelihood"] = likelihood.astype(str)
+    gauss = params["likelihood"] == "gaussian"
+    noise = params["noise"].copy()
+    b = params["b"].copy()
+    core.mstep(segments, params, config)
+
+    y = np.concatenate([s["y"] for s in segments])
+    x = np.concatenate([s["x"] for s in segments])
+    mu = np.concatenate([s["mu"] for s in segments])
+    v = np.concatenate([s["v"] for s in segments])
+    M = mu.T @ mu + np.diag(v.sum(axis=0))
+    for n in np.flatnonzero(gauss):
+        assert np.allclose(
+            M @ params["a"][:, n], mu.T @ (y[:, n] - x[..., n] @ b[:, n])
+        )
+    assert np.array_equal(params["noise"][~gauss], noise[~gauss])
+
+
+def test_chunked_mstep(make_segments):
+    segments, params, config = make_segments(Mniter=3)
+    likelihood = params["likelihood"].astype(object)
+    likelihood[::3] = "gaussian"
+    params["likelihood"] = likelihood.astype(str)
+    resident = copy.deepcopy(params)
+    core.mstep(segments, resident, config)
+
+    config["Mchunk"] = 120  # two segments per chunk
+    core.mstep(segments, params, config)
+    for key in ("a", "b", "da", "db", "noise"):
+        assert np.allclose(resident[key], params[key])
+
+
+def test_hstep_schedule(make_segments, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        core, "hstep", lambda trials, params, config, **kwargs: calls.append(1)
+    )
+    segments, params, config = make_segments(
+        Eniter=1, Mniter=1, max_iter=5, min_iter=5, Hevery=2
+    )
+    core.vem(segments, params, config)
+    assert len(calls) == 3  # iterations 0, 2 and 4
+
+
+def test_hstep_sample(make_segments, monkeypatch):
+    from vlgp import gp
+
+    segments, params, config = make_segments(Eniter=5, Hsample=5, Hseed=1)
+    core.estep(segments, params, config)  # moves omega off its initial bound
+    sampled = []
+    stack_trials = gp.stack_trials
+    monkeypatch.setattr(
+        gp,
+        "stack_trials",
+        lambda trials, key: sampled.append(trials) or stack_trials(trials, key),
+    )
+    results = []
+    for _ in range(2):
+        p = copy.deepcopy(params)
+        core.hstep(segments, p, config, rng=np.random.RandomState(config["Hseed"]))
+        results.append(p["omega"])
+    assert np.array_equal(*results)
+    assert not np.array_equal(results[0], params["omega"])
+
+    # the same seed draws the same trials
+    index = np.sort(
+        np.random.RandomState(config["Hseed"]).choice(len(segments), 5, replace=False)
+    )
+    subset = [segments[i] for i in index]
+    assert all(trials == subset for trials in sampled)
+
+    # and omega is fitted to them alone
+    p = copy.deepcopy(params)
+    core.hstep(subset, p, dict(config, Hsample=0))
+    assert np.array_equal(p["omega"], results[0])
+
+
+def test_infer_long(make_segments, tmp_path):
+    segments, params, config = make_segments(max_iter=5)
+    y = np.concatenate([segment["y"] for segment in segments[:4]])
+    window = config["window"]
+
+    # chunks without overlap are the E step on each of them
+    config.update(Echunk=window, Eoverlap=0, Eblock=3)
+    priors = params["cholesky"], params["precision"]
+    long = core.infer_long({"y": y}, params, dict(config, Eniter=5))
+    # chunk priors kept local
+    assert params["cholesky"] is priors[0] and params["precision"] is priors[1]
+    x = np.ones((window, params["xdim"], params["ydim"]))
+    chunks = [
+        {"y": y[i : i + window], "x": x, "mu": np.zeros((window, params["zdim"]))}
+        for i in range(0, y.shape[0], window)
+    ]
+    fill_trials(chunks)
+    core.infer(chunks, params, dict(config, Echunk=0))
+    assert np.allclose(long["mu"], np.concatenate([c["mu"] for c in chunks]))
+    assert np.allclose(long["v"], np.concatenate([c["v"] for c in chunks]))
+
+    # tapered overlaps written to disk
+    trial = {"y": y, "mu": np.zeros((y.shape[0], params["zdim"]))}
+    core.infer([trial], params, dict(config, Eoverlap=10, Epath=str(tmp_path)))
+    mu = np.load(tmp_path / "trial-0" / "mu.npy", mmap_mode="r")
+    assert mu.shape == (y.shape[0], params["zdim"])
+    assert np.array_equal(trial["mu"], mu)
+    assert np.all(np.isfinite(mu))
+    assert np.corrcoef(mu[:, 0], long["mu"][:, 0])[0, 1] > 0.9
+
+
+def test_infer_long_parallel(make_segments, monkeypatch):
+    # every trial is longer than the chunk, no short trial is left to the pool
+    segments, params, config = make_segments(max_iter=3)
+    y = np.concatenate([segment["y"] for segment in segments[:4]])
+    config.update(Echunk=config["window"], Eoverlap=10, Eblock=2)
+    serial = [{"y": y}]
+    core.infer(serial, params, dict(config))
+
+    # one pool for all blocks of chunks
+    pools = []
+    TrialPool = core.TrialPool
+    monkeypatch.setattr(
+        core, "TrialPool", lambda *args: pools.append(1) or TrialPool(*args)
+    )
+    trials = [{"y": y}]
+    core.infer(trials, params, dict(config, parallel=2))
+    assert len(pools) == 1
+    for key in ("mu", "v"):
+        assert np.allclose(trials[0][key], serial[0][key])
+
+
+def test_stochastic_vem(make_segments):
+    segments, params, config = make_segments(
+        Eniter=2, Mniter=2, minibatch=3, epochs=2, seed=0
+    )
+    core.vem(segments, params, config)
+    runtime = config["runtime"]
+    assert runtime["epoch"] == 2
+    assert runtime["it"] == 12  # six minibatches of 16 segments per epoch
+    assert runtime["e_active"][:6] == [3, 3, 3, 3, 3, 1]
+    assert runtime["rate"][0] == 1.0 and np.all(np.diff(runtime["rate"]) < 0)
+    assert np.all(np.isfinite(params["a"])) and np.all(np.isfinite(params["omega"]))
+
+    # a step on the whole set is an M step iteration, damped by the rate
+    segments, params, config = make_segments(Mniter=2, constrain_loading="none")
+    full = copy.deepcopy(params)
+    core.mstep(segments, full, dict(config, Mniter=1))
+    for rate_delay, rate in ((1.0, 1.0), (4.0, 0.5)):
+        p = copy.deepcopy(params)
+        config.update(
+            minibatch=len(segments),
+            epochs=1,
+            Eniter=0,
+            Hstep=False,
+            rate_delay=rate_delay,
+            rate_decay=0.5,
+        )
+        core.svem(segments, p, config)
+        for key in ("a", "b"):
+            assert np.allclose(p[key], params[key] + rate * (full[key] - params[key]))
+
+
+def test_squarem(make_segments):
+    np.random.seed(0)
+    state = [np.random.randn(3, 2), np.random.randn(4)]
+    # a linear map with contraction 0.9 is solved in one extrapolation
+    states = [state, [0.9 * x for x in state], [0.81 * x for x in state]]
+    assert all(np.allclose(x, 0) for x in core.squarem_step(*states))
+
+    segments, params, config = make_segments(
+        Eniter=3, Mniter=3, max_iter=8, min_iter=8, squarem=True
+    )
+    core.vem(segments, params, config)
+    runtime = config["runtime"]
+    assert len(runtime["squarem"]) == 2  # at the start of iterations 2 and 5
+    assert np.all(np.isfinite(params["a"]))
+    assert all(np.all(np.isfinite(segment["mu"])) for segment in segments)
+
+    # without a loading constraint the iterations raise the ELBO and the steps are kept
+    # SQUAREM gets beyond the ELBO of 30 plain iterations in 20
+    values = {}
+    for squarem, max_iter in ((False, 30), (True, 20)):
+        segments, params, config = make_segments(
+            Eniter=3,
+            Mniter=3,
+            max_iter=max_iter,
+            min_iter=max_iter,
+            Hstep=False,
+            constrain_loading="none",
+            squarem=squarem,
+        )
+        core.vem(segments, params, config)
+        core.update_posterior(segments, params, config)
+        values[squarem] = core.objective(segments, params)
+    assert values[True] > values[False]
+
+
+def test_objective(make_segments):
+    # the E step raises the ELBO under exact and low-rank priors
+    segments, params, config = make_segments(Eniter=1)
+    for precision in (params["precision"], {}):
+        trials = copy_trials(segments)
+        p = dict(params, precision=precision)
+        values = []
+        for _ in range(4):
+            core.update_posterior(trials, p, config)
+            values.append(core.objective(trials, p))
+            core.estep(trials, p, config)
+        assert np.all(np.diff(values) > 0)
+
+    # a square prior factor is the same prior in other coordinates
+    trials = copy_trials(segments)
+    core.update_posterior(trials, params, config)
+    assert np.isclose(
+        core.objective(trials, params),
+        core.objective(trials, dict(params, precision={})),
+    )
+
+
+def test_failed_step(make_segments):
+    # the posterior precision of the first latent of the first trial is not definite
+    segments, params, config = make_segments(Eniter=1)
+    segments[0]["w"][:, 0] = -1e6
+    mu = segments[0]["mu"][:, 0].copy()
+    for options in ({"batch": 0}, {"batch": 5}, {"batch": 5, "joint": True}):
+        trials = copy_trials(segments)
+        core.estep(trials, params, dict(config, **options))
+        assert np.array_equal(trials[0]["mu"][:, 0], mu)
+        assert np.all(np.isfinite(trials[0]["mu"]))
+        assert not np.array_equal(trials[1]["mu"][:, 0], segments[1]["mu"][:, 0])
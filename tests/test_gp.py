@@ -0,0 +1,147 @@
+import numpy as np
+
+from vlgp.gp import PriorCache, make_cholesky, prior_cache
+from vlgp.preprocess import get_config
+
+
+def test_make_cholesky():
+    config = get_config()
+    params = {
+        "zdim": 2,
+        "rank": 10,
+        "sigma": np.ones(2),
+        "omega": np.array([1e-2, 1e-3]),
+        "gp_noise": 1e-4,
+    }
+    trials = [{"y": np.zeros((length, 3))} for length in (20, 30, 20, 8)]
+
+    make_cholesky(trials, params, config)
+    assert sorted(params["cholesky"]) == [8, 20, 30]
+    assert params["cholesky"][30][0].shape == (30, 10)
+
+    # exact prior of short trials
+    G = params["cholesky"][8][0]
+    assert G.shape == (8, 8)
+    assert np.allclose(G @ G.T @ params["precision"][8][0], np.eye(8))
+    assert sorted(params["precision"]) == [8]
+
+    # unchanged hyperparameters reuse the factors
+    first = params["cholesky"]
+    params["omega"] = np.array([1e-2, 2e-3])
+    make_cholesky(trials, params, config)
+    assert params["cholesky"][20][0] is first[20][0]
+    assert params["cholesky"][20][1] is not first[20][1]
+    assert prior_cache.nbytes <= config["cache_size"]
+
+
+def test_prior_cache_eviction():
+    cache = PriorCache(maxbytes=2 * 20 * 5 * 8)
+    G, _ = cache.get(20, [1e-2, 2e-2], [1.0, 1.0], 5)
+    cache.get(20, [1e-2], [1.0], 5)  # most recent
+    cache.get(20, [3e-2], [1.0], 5)  # evicts 2e-2
+    assert len(cache.factors) == 2
+    assert cache.get(20, [1e-2], [1.0], 5)[0] is G
+    assert cache.misses == 3
+
+
+def test_toeplitz_elbo():
+    from vlgp.gp import elbo, toeplitz_elbo, construct_posterior_cov
+
+    np.random.seed(0)
+    t = np.arange(40) * 1.0
+    mu = np.random.randn(40, 5)
+    w = np.random.rand(40, 5)
+    params = np.array([0.8, 2e-2, 1e-3])
+    mask = np.array([1, 1, 1])
+    ll, dll = elbo(params, mask, t, mu, construct_posterior_cov(t, w, params.copy()))
+    ll_toeplitz, dll_toeplitz = toeplitz_elbo(params, mask, t, mu, w)
+    assert np.isclose(ll, ll_toeplitz)
+    assert np.allclose(dll, dll_toeplitz)
+
+
+def test_chunked_elbo(monkeypatch):
+    from vlgp import gp
+
+    np.random.seed(0)
+    t = np.arange(40) * 1.0
+    mu = np.random.randn(40, 7)
+    w = np.random.rand(40, 7)
+    params = np.array([0.8, 2e-2, 1e-3])
+    mask = np.array([1, 1, 1])
+    for rank in (None, 10):
+        ll, dll = gp.toeplitz_elbo(params, mask, t, mu, w, rank)
+        # 1 dense or 3 low-rank trials per chunk
+        monkeypatch.setattr(gp, "POSTERIOR_CHUNK", 40 * 10 * 3)
+        ll_chunked, dll_chunked = gp.toeplitz_elbo(params, mask, t, mu, w, rank)
+        monkeypatch.undo()
+        assert np.isclose(ll, ll_chunked)
+        assert np.allclose(dll, dll_chunked)
+
+
+def test_toeplitz_logdet():
+    import pytest
+    from numpy.linalg import LinAlgError
+    from scipy.linalg import toeplitz
+    from vlgp.gp import toeplitz_logdet
+
+    for n in (1, 2, 5, 60):
+        c = np.exp(-0.01 * np.arange(n) ** 2)
+        c[0] += 1e-3
+        assert np.isclose(toeplitz_logdet(c), np.linalg.slogdet(toeplitz(c))[1])
+    with pytest.raises(LinAlgError):
+        toeplitz_logdet(np.array([1.0, 2.0]))
+
+
+def test_lowrank_elbo():
+    from vlgp.gp import toeplitz_elbo
+
+    np.random.seed(0)
+    t = np.arange(80) * 1.0
+    mu = np.random.randn(80, 5)
+    w = np.random.rand(80, 5)
+    params = np.array([0.8, 2e-3, 1e-3])
+    mask = np.array([1, 1, 1])
+    ll, dll = toeplitz_elbo(params, mask, t, mu, w)
+    ll_lowrank, dll_lowrank = toeplitz_elbo(params, mask, t, mu, w, 30)
+    assert np.isclose(ll, ll_lowrank)
+    assert np.allclose(dll, dll_lowrank)
+
+
+def test_parallel_optimize(make_segments):
+    import copy
+    from vlgp.gp import optimize
+
+    segments, params, config = make_segments(ntrial=4)
+    serial = copy.deepcopy(params)
+    optimize(segments, serial, config)
+
+    config["parallel"] = 2
+    optimize(segments, params, config)
+    assert np.array_equal(serial["omega"], params["omega"])
+    assert np.array_equal(serial["sigma"], params["sigma"])
+
+
+def test_free_hyperparameters(make_segments):
+    from vlgp.gp import elbo, kernel, optimize, construct_posterior_cov
+
+    t = np.arange(20) * 1.0
+    params = np.array([0.8, 2e-2, 1e-3])
+    _, dK = kernel(t, params, mask=(0, 1, 0))
+    assert dK.shape == (20, 20, 1)
+
+    np.random.seed(0)
+    mu = np.random.randn(20, 3)
+    S = construct_posterior_cov(t, np.random.rand(20, 3), params.copy())
+    _, dll = elbo(params, np.array([0, 1, 0]), t, mu, S)
+    _, dll_all = elbo(params, np.array([1, 1, 1]), t, mu, S)
+    assert dll[0] == dll[2] == 0
+    assert np.isclose(dll[1], dll_all[1])
+
+    segments, params, config = make_segments(ntrial=4)
+    params["sigma"][:] = 0.5  # inside the bounds
+    sigma = params["sigma"].copy()
+    optimize(segments, params, config)
+    assert np.array_equal(params["sigma"], sigma)
+    config["Hsigma"] = True
+    optimize(segments, params, config)
+    assert not np.array_equal(params["sigma"], sigma)
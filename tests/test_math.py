@@ -1,7 +1,7 @@
 import numpy as np
 from scipy.linalg import toeplitz
 
-from vlgp.math import ichol_gauss, orth, rectify
+from vlgp.math import ichol_gauss, orth, rectify, trunc_exp
 
 
 def test_ichol_gauss():
@@ -14,6 +14,17 @@ def test_ichol_gauss():
     assert np.allclose(K, G @ G.T)
 
 
+def test_ichol_gauss_batch():
+    n = 200
+    omega = np.array([1e-3, 1e-2, 1e-1])
+    G = ichol_gauss(n, omega, n)
+    assert G.shape == (3, n, n)
+    for i in range(3):
+        assert np.allclose(G[i], ichol_gauss(n, omega[i], n))
+        K = toeplitz(np.exp(-omega[i] * np.arange(n) ** 2))
+        assert np.allclose(K, G[i] @ G[i].T, atol=1e-5)
+
+
 def test_orth():
     n = 500
     p = 200
@@ -28,3 +39,18 @@ def test_rectify():
     n = 5000
     x = np.random.randn(n)
     assert np.array_equal(rectify(x), np.maximum(0, x))
+
+
+def test_trunc_exp():
+    x = np.linspace(-5, 15, 50)
+    expected = np.exp(np.minimum(x, 10))
+    assert np.array_equal(trunc_exp(x), expected)
+
+    out = np.empty_like(x)
+    assert trunc_exp(x, out=out) is out
+    assert np.array_equal(out, expected)
+
+    # in place
+    y = x.copy()
+    assert trunc_exp(y, out=y) is y
+    assert np.array_equal(y, expected)
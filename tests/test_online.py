@@ -0,0 +1,45 @@
+import numpy as np
+
+from vlgp import core
+from vlgp.gp import make_cholesky
+from vlgp.online import OnlineFilter
+
+
+def test_online_window(make_segments):
+    segments, params, config = make_segments()
+    window = config["window"]
+    y = segments[0]["y"]
+    online = OnlineFilter(params, config, niter=10)
+    mu, v = online.update(y)
+    assert mu.shape == v.shape == (window, params["zdim"])
+
+    # a full window from scratch is the E step on it
+    trial = {
+        "y": y,
+        "x": np.ones((window, params["xdim"], params["ydim"])),
+        "mu": np.zeros((window, params["zdim"])),
+        "w": np.zeros((window, params["zdim"])),
+        "v": np.zeros((window, params["zdim"])),
+        "dmu": np.zeros((window, params["zdim"])),
+    }
+    make_cholesky([trial], params, config)
+    core.update_w([trial], params, config)
+    core.update_v([trial], params, config)
+    core.infer_single_trial(trial, params, dict(config, Eniter=10))
+    assert np.allclose(trial["mu"], mu)
+    assert np.allclose(trial["v"], v)
+
+
+def test_online_bins(make_segments):
+    segments, params, config = make_segments()
+    online = OnlineFilter(params, config, window=20, niter=2)
+    y = np.concatenate([segment["y"] for segment in segments[:2]])
+    filtered = [online.update(row) for row in y[:30]]
+    mu = np.concatenate([m for m, _ in filtered])
+    assert mu.shape == (30, params["zdim"])
+    assert np.all(np.isfinite(mu))
+    assert online.trial["y"].shape[0] == 20  # bounded buffer
+
+    mu, v = online.update(y[30:75])  # longer than the window
+    assert mu.shape == v.shape == (45, params["zdim"])
+    assert np.all(v > 0)
@@ -0,0 +1,80 @@
+import pickle
+
+import numpy as np
+
+from vlgp.trialset import TrialSet
+from vlgp.util import (
+    blend_segments,
+    chunk_trials,
+    concat_trials,
+    cut_trials,
+    norm_trials,
+)
+
+
+def make_trials():
+    np.random.seed(0)
+    return [
+        {"y": np.random.poisson(1.0, size=(n, 3)), "mu": np.random.randn(n, 2), "id": i}
+        for i, n in enumerate((5, 7, 4))
+    ]
+
+
+def test_views():
+    trials = make_trials()
+    mu = np.concatenate([trial["mu"] for trial in trials])
+    trialset = TrialSet(trials)
+    assert list(trialset.arrays) == ["y", "mu"]
+    assert trialset[1] is trials[1]
+    assert np.array_equal(trialset.concat("mu"), mu)
+
+    trials[1]["mu"][:] = 0  # the trials are views of the buffer
+    assert np.all(trialset.arrays["mu"][5:12] == 0)
+
+    tail = trialset[1:]
+    assert isinstance(tail, TrialSet)
+    assert np.shares_memory(tail.concat("mu"), trialset.arrays["mu"])
+    assert np.array_equal(tail.lengths, [7, 4])
+
+
+def test_chunks():
+    trialset = TrialSet(make_trials())
+    chunks = chunk_trials(trialset, 12)
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert all(concat_trials(chunk, "y").base is not None for chunk in chunks)  # views
+    assert np.isclose(
+        norm_trials(trialset, "mu"), np.linalg.norm(trialset.concat("mu"))
+    )
+
+
+def test_cut_trials():
+    np.random.seed(0)
+    trials = [
+        {k: np.random.randn(n, 2) for k in ("y", "mu", "w", "v", "dmu")}
+        for n in (10, 15)
+    ]
+    for trial in trials:
+        trial["x"] = np.ones((trial["y"].shape[0], 1, 2))
+    trialset = TrialSet(trials)
+
+    # the segments tile the buffers of the trials
+    segments = cut_trials(trialset, None, {"window": 5})
+    assert len(segments) == 5
+    assert all(segments.arrays[key] is trialset.arrays[key] for key in segments.arrays)
+    assert np.shares_memory(segments[3]["mu"], trials[1]["mu"])
+
+    # overlapping segments are kept in buffers of their own and blended back
+    segments = cut_trials(trialset, None, {"window": 4})
+    assert len(segments) == 7
+    assert not np.shares_memory(segments.arrays["mu"], trialset.arrays["mu"])
+    segments.arrays["mu"][:] = 1
+    blend_segments(segments)
+    assert np.all(trialset.arrays["mu"] == 1)
+
+
+def test_pickle():
+    trialset = TrialSet(make_trials())
+    loaded = pickle.loads(pickle.dumps(trialset))
+    assert loaded[2]["id"] == 2
+    assert np.array_equal(loaded.concat("mu"), trialset.concat("mu"))
+    assert np.shares_memory(loaded[0]["mu"], loaded.arrays["mu"])
@@ -6,3 +6,43 @@ def test_save():
     save(fit, fit["config"]["path"])
     path = pathlib.Path(fit["config"]["path"])
     path.unlink()
+
+
+def test_load(tmp_path):
+    import pytest
+    from vlgp.util import save, load
+
+    fit = {"trials": {}, "params": {}, "config": {}}
+    path = tmp_path / "fit.npy"
+    save(fit, path)
+    with pytest.raises(ValueError):
+        load(path)
+    assert load(path, allow_pickle=True) == fit
+
+
+def test_blend_segments():
+    import numpy as np
+    from vlgp.util import cut_trial, blend_segments
+
+    np.random.seed(0)
+    length, window = 130, 50
+    trial = {k: np.random.randn(length, 2) for k in ("y", "mu", "w", "v")}
+    trial["x"] = np.ones((length, 1, 2))
+    segments = cut_trial(trial, window)
+    assert len(segments) == 3
+    assert any(segment["overlap"] for segment in segments)
+    for segment in segments:
+        assert np.shares_memory(segment["mu"], trial["mu"]) != segment["overlap"]
+        segment["mu"][:] = segment["start"]  # distinct values in every segment
+
+    blend_segments(segments)
+    count = np.zeros(length)
+    total = np.zeros(length)
+    for segment in segments:
+        count[segment["start"] : segment["start"] + window] += 1
+        total[segment["start"] : segment["start"] + window] += segment["start"]
+    assert np.allclose(trial["mu"], (total / count)[:, np.newaxis])
+    for segment in segments:
+        assert np.array_equal(
+            segment["mu"], trial["mu"][segment["start"] : segment["start"] + window]
+        )
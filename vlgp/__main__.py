@@ -9,10 +9,11 @@ from . import api, util
 @click.argument("n_factors", type=click.INT, metavar='<number of factors>')
 @click.option("--max_iter", type=click.INT, default=20, help="Maximum number of iterations")
 @click.option("--min_iter", type=click.INT, default=5, help="Minimum number of iterations")
-def cli(fin, fout, n_factors, max_iter, min_iter):
+@click.option("--allow_pickle", is_flag=True, help="Allow pickled input files")
+def cli(fin, fout, n_factors, max_iter, min_iter, allow_pickle):
     """variational Latent Gaussian Process (vLGP)"""
     click.echo("Loading {}".format(fin))
-    trials = util.load(fin)
+    trials = util.load(fin, allow_pickle=allow_pickle)
     click.secho("{} loaded".format(fin), fg="green")
 
     result = api.fit(trials, n_factors, max_iter=max_iter, min_iter=min_iter, path=fout)
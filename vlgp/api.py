@@ -5,9 +5,8 @@ import click
 
 from .preprocess import get_params, get_config, fill_trials, fill_params, initialize
 from .callback import Saver, show
-from .core import vem, update_w, update_v, infer
-from .util import cut_trials
-from .gp import make_cholesky
+from .core import vem, infer, prepare_segments
+from .trialset import TrialSet
 
 __all__ = ["fit"]
 
@@ -48,13 +47,8 @@ def fit(trials, n_factors, **kwargs):
     fill_params(params)
 
     fill_trials(trials)
-    make_cholesky(trials, params, config)
-    update_w(trials, params, config)
-    update_v(trials, params, config)
-
-    splits = cut_trials(trials, params, config)
-    make_cholesky(splits, params, config)
-    fill_trials(splits)
+    trials = TrialSet(trials)  # contiguous, the trials are views
+    splits = prepare_segments(trials, params, config)
 
     params["initial"] = copy.deepcopy(params)
 
@@ -63,9 +57,6 @@ def fit(trials, n_factors, **kwargs):
     vem(splits, params, config)
 
     # E step only for inference given above estimated parameters and hyperparameters
-    make_cholesky(trials, params, config)
-    update_w(trials, params, config)
-    update_v(trials, params, config)
     click.echo("Inferring")
     infer(trials, params, config)
 
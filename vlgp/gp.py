@@ -1,19 +1,28 @@
 """
 Optimization code for Gaussian Process
 """
+import concurrent.futures
+from collections import OrderedDict
+
 import numpy as np
 from numpy.linalg import LinAlgError
-from scipy.linalg import cholesky, cho_solve
+from scipy.linalg import cholesky, cho_solve, solve_toeplitz, toeplitz
 from scipy.spatial.distance import pdist, squareform
 
 from .math import ichol_gauss
+from .util import sqexpcov, stack_trials
+
+# elements of the per-trial arrays of the posterior terms made at once
+POSTERIOR_CHUNK = 2 ** 20
 
 
 def elbo(params, mask, *args):
-    """ELBO with full posterior covariance matrix"""
+    """ELBO with full posterior covariance matrix
+    Only the derivatives of the parameters in mask are computed, the others are zero.
+    """
     t, mu, post_cov = args
-    K, dK = kernel(t, params)
-    dK *= mask[np.newaxis, np.newaxis, :]
+    free = np.flatnonzero(mask)
+    K, dK = kernel(t, params, mask)
     try:
         L = cholesky(K, lower=True)
     except LinAlgError:
@@ -37,33 +46,184 @@ def elbo(params, mask, *args):
     ll_dims -= np.log(np.diag(L)).sum()
     ll = ll_dims.sum(-1)
 
-    dll_dims = 0.5 * np.einsum("ijl,ijk->kl", tmp, dK)
-    dll = dll_dims.sum(-1)
+    dll = np.zeros(len(params))
+    dll[free] = 0.5 * np.einsum("ijl,ijk->k", tmp, dK)
 
     return ll, dll
 
 
-def kernel(x, params):
-    """kernel matrix and derivatives"""
+def kernel(x, params, mask=(1, 1, 1)):
+    """kernel matrix and derivatives by log parameters
+    :param mask: derivatives to compute of (sigma^2, omega, noise)
+    :return: K, (T, T, #derivatives) dK
+    """
     sigmasq, omega, eps = params
+    mask = np.asarray(mask, dtype=bool)
 
     dists = pdist(
         x.reshape(-1, 1), metric="sqeuclidean"
     )  # vector of pairwise squared distance
     Dsq = squareform(dists)  # distance matrix
     K = np.exp(-omega * Dsq)  # kernel matrix
-    dK_dsigmasq = K
     # K *= 1.0 - eps  # fix variance = 1 - eps (noise variance)
     K *= sigmasq
-    dK_dlnomega = -K * Dsq * omega
+
+    dK = np.empty(K.shape + (np.count_nonzero(mask),))
+    i = 0
+    if mask[0]:
+        dK[..., i] = K
+        i += 1
+    if mask[1]:
+        dK[..., i] = -K * Dsq * omega
+        i += 1
+    if mask[2]:
+        dK[..., i] = np.eye(K.shape[0]) * eps
+
     K[np.diag_indices_from(K)] += eps
-    dK_deps = np.eye(K.shape[0]) * eps
-    dK = np.dstack([dK_dsigmasq, dK_dlnomega, dK_deps])
     return K, dK
 
 
-def optimize(trials, params, config):
-    """Optimize hyperparameters"""
+def toeplitz_elbo(params, mask, *args):
+    """ELBO of evenly spaced time points without the inverse kernel
+    With B = I + W^1/2 K W^1/2 and the optimal posterior covariance S,
+    tr(K^-1 S) = tr(B^-1) and K^-1 - K^-1 S K^-1 = W^1/2 B^-1 W^1/2.
+    The kernel is Toeplitz, so its solve and determinant take O(T^2) by Levinson
+    recursion and the derivatives only need the sums of diagonals by lag, which for mu
+    are made by FFT.
+    :param args: t, (time, trial) mu and w, and optionally the rank of the prior in the
+        posterior terms
+    """
+    t, mu, w = args[:3]
+    rank = args[3] if len(args) > 3 else None
+    sigmasq, omega, eps = params
+
+    if mu.ndim == 1:
+        mu = mu[:, np.newaxis]
+    if w.ndim == 1:
+        w = w[:, np.newaxis]
+    n, ntrial = mu.shape
+
+    # first columns of the kernel and the free derivatives by log parameters
+    free = np.flatnonzero(mask)
+    tausq = (t - t[0]) ** 2
+    c = sigmasq * np.exp(-omega * tausq)
+    dc = np.zeros((free.size, n))
+    for i, j in enumerate(free):
+        if j == 0:
+            dc[i] = c
+        elif j == 1:
+            dc[i] = -c * tausq * omega
+        else:
+            dc[i, 0] = eps
+    c[0] += eps
+
+    try:
+        logdet = toeplitz_logdet(c)
+        if rank is not None and rank < n:
+            G = np.sqrt(sigmasq) * ichol_gauss(n, omega, rank, dt=t[1] - t[0])
+            terms, width = lambda w: lowrank_posterior_terms(G, eps, w), rank
+        else:
+            terms, width = lambda w: dense_posterior_terms(c, w), n
+        # a chunk of trials at a time, summed
+        size = max(POSTERIOR_CHUNK // (n * width), 1)
+        trace, lags = 0, 0
+        for start in range(0, ntrial, size):
+            chunk_trace, chunk_lags = terms(w[:, start : start + size].T)
+            trace += chunk_trace
+            lags += chunk_lags
+    except LinAlgError:
+        return -np.inf, np.zeros_like(params)
+    alpha = solve_toeplitz(c, mu)
+
+    ll = -0.5 * np.sum(mu * alpha) - 0.5 * trace - 0.5 * ntrial * logdet
+
+    # sum_k alpha_k alpha_k' - W_k^1/2 B_k^-1 W_k^1/2
+    dll = np.zeros(len(params))
+    dll[free] = 0.5 * dc @ (outer_lag_sums(alpha) - lags)
+
+    return ll, dll
+
+
+def dense_posterior_terms(c, w):
+    """sum_k tr(B_k^-1) and the lag sums of sum_k W_k^1/2 B_k^-1 W_k^1/2
+    :param c: first column of the kernel
+    :param w: (trial, time)
+    """
+    n = c.shape[0]
+    sw = np.sqrt(w)
+    B = sw[:, :, np.newaxis] * toeplitz(c) * sw[:, np.newaxis, :]
+    B[:, np.arange(n), np.arange(n)] += 1
+    L = np.linalg.cholesky(B)
+    Linv = np.linalg.solve(L, np.broadcast_to(np.eye(n), B.shape))
+    trace = np.sum(Linv ** 2)
+    # B^-1 = Linv' Linv, so W^1/2 B^-1 W^1/2 sums xx' over the rows x of Linv W^1/2
+    Linv *= sw[:, np.newaxis, :]
+    return trace, outer_lag_sums(np.moveaxis(Linv, 2, 0))
+
+
+def lowrank_posterior_terms(G, eps, w):
+    """Same as dense_posterior_terms for the kernel GG' + eps I in O(T r^2) per trial
+    B^-1 = D^-1 - QQ' with D = I + eps W, U = W^1/2 G, LL' = I + U'D^-1 U
+    and Q = D^-1 U L'^-1
+    """
+    d = 1 + eps * w
+    sw = np.sqrt(w)
+    DU = (sw / d)[:, :, np.newaxis] * G
+    C = np.swapaxes(DU, 1, 2) @ (sw[:, :, np.newaxis] * G)
+    C[:, np.arange(G.shape[1]), np.arange(G.shape[1])] += 1
+    L = np.linalg.cholesky(C)
+    Q = np.swapaxes(np.linalg.solve(L, np.swapaxes(DU, 1, 2)), 1, 2)
+
+    trace = np.sum(1 / d) - np.sum(Q ** 2)
+    # W^1/2 B^-1 W^1/2 = diag(w / d) - PP', P = W^1/2 Q
+    lags = -outer_lag_sums(np.moveaxis(sw[:, :, np.newaxis] * Q, 1, 0))
+    lags[0] += np.sum(w / d)
+    return trace, lags
+
+
+def toeplitz_logdet(c):
+    """Log determinant of a positive definite Toeplitz matrix by Durbin recursion
+    :param c: first column
+    """
+    err = c[0]
+    if err <= 0:
+        raise LinAlgError("Toeplitz matrix is not positive definite")
+    logdet = np.log(err)
+    n = c.shape[0]
+    a = np.zeros(n)  # coefficients of prediction, the first k - 1 are in use at step k
+    reverse = np.zeros(n)
+    for k in range(1, n):
+        m = k - 1
+        reflection = (c[k] - a[:m] @ c[m:0:-1]) / err
+        np.copyto(reverse[:m], a[:m][::-1])
+        a[:m] -= reflection * reverse[:m]
+        a[m] = reflection
+        err *= 1 - reflection ** 2
+        if err <= 0:
+            raise LinAlgError("Toeplitz matrix is not positive definite")
+        logdet += np.log(err)
+    return logdet
+
+
+def outer_lag_sums(X):
+    """Sums of the diagonals by lag of the sum of xx' over the columns x of X by FFT
+    tr(XX' T(c)) = outer_lag_sums(X) @ c for symmetric Toeplitz T(c)
+    :param X: (time, ...)
+    """
+    n = X.shape[0]
+    spectrum = np.fft.rfft(X.reshape(n, -1), 2 * n, axis=0)
+    sums = np.fft.irfft(np.sum(np.abs(spectrum) ** 2, axis=1), 2 * n)[:n]
+    sums[1:] *= 2  # both sides of the diagonal
+    return sums
+
+
+def optimize(trials, params, config, executor=None, rng=None):
+    """Optimize hyperparameters
+    The latent dimensions are independent problems, in parallel if config["parallel"].
+    If config["Hsample"] is set, they are fitted to a random subset of that many trials.
+    :param executor: executor of the problems, a process pool is made on demand if None
+    :param rng: random state of the subset, numpy's global one if None
+    """
     zdim = params["zdim"]
     rank = params["rank"]
     dt = params["dt"]  # binwidth, set to 1 temporarily
@@ -74,20 +234,52 @@ def optimize(trials, params, config):
     gp_noise = params["gp_noise"]
 
     # trials
-    mu = np.stack([trial["mu"] for trial in trials])
-    w = np.stack([trial["w"] for trial in trials])
+    sample = config["Hsample"]
+    if sample and sample < len(trials):
+        rng = np.random if rng is None else rng
+        sampled = [
+            trials[i] for i in np.sort(rng.choice(len(trials), sample, replace=False))
+        ]
+    else:
+        sampled = trials
+    mu = stack_trials(sampled, "mu")
+    w = stack_trials(sampled, "w")
     window = config["window"]
     t = np.arange(window) * dt  # absolute time
 
-    for l in range(zdim):
-        initial = (sigma[l] ** 2, omega[l], gp_noise)
-        bounds = ((1e-3, 1), config["omega_bound"], (gp_noise / 2, gp_noise * 2))
-        mask = np.array([0, 1, 0])
-
-        # transpose each latent dimension to (window, #trials/segments)
-        (sigmasq, omega_new, _), fun = optimze1d(
-            t, mu[:, :, l].T, w[:, :, l].T, initial, bounds, mask=mask
+    bounds = ((1e-3, 1), config["omega_bound"], (gp_noise / 2, gp_noise * 2))
+    # sigma and omega are fused if both are free
+    mask = np.array([config["Hsigma"], 1, 0], dtype=int)
+
+    # transpose each latent dimension to (window, #trials/segments)
+    problems = [
+        (
+            t,
+            mu[:, :, l].T,
+            w[:, :, l].T,
+            (sigma[l] ** 2, omega[l], gp_noise),
+            bounds,
+            mask,
+            rank,
         )
+        for l in range(zdim)
+    ]
+    if config["parallel"] and zdim > 1:
+        if executor is None:
+            max_workers = (
+                None if config["parallel"] is True else int(config["parallel"])
+            )
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(max_workers or zdim, zdim)
+            ) as pool:
+                results = list(pool.map(optimze1d, *zip(*problems)))
+        else:
+            results = list(executor.map(optimze1d, *zip(*problems)))
+    else:
+        results = [optimze1d(*problem) for problem in problems]
+
+    # merged in the order of latents
+    for l, ((sigmasq, omega_new, _), fun) in enumerate(results):
         if not np.any(np.isclose(omega_new, config["omega_bound"])):
             omega[l] = omega_new
         sigma[l] = np.sqrt(sigmasq)
@@ -97,22 +289,26 @@ def optimize(trials, params, config):
     make_cholesky(trials, params, config)
 
 
-def optimze1d(t, mu, w, params, bounds, mask):
-    """Optimize hyperparameters of a single dimension"""
+def optimze1d(t, mu, w, params, bounds, mask, rank=None):
+    """Optimize hyperparameters of a single dimension
+    Only the parameters in mask are optimized.
+    :param rank: rank of the prior in the posterior terms, exact if None or >= window
+    """
     from scipy.optimize import minimize
 
     log_params = np.log(params)
     log_bounds = np.log(bounds)
+    free = np.flatnonzero(mask)
 
     def obj_func(x):
-        expx = np.exp(x)
-        post_cov = construct_posterior_cov(t, w, expx)
-        ll, dll = elbo(expx, mask, t, mu, post_cov)
-        return -ll, -dll
+        expx = np.exp(log_params)
+        expx[free] = np.exp(x)
+        ll, dll = toeplitz_elbo(expx, mask, t, mu, w, rank)
+        return -ll, -dll[free]
 
     try:
-        res = minimize(obj_func, log_params, jac=True, bounds=log_bounds)
-        log_params = res.x
+        res = minimize(obj_func, log_params[free], jac=True, bounds=log_bounds[free])
+        log_params[free] = res.x
         fun = res.fun
         # opt, fval, info = fmin_l_bfgs_b(obj_func, log_params,
         #                                 bounds=log_bounds)
@@ -126,7 +322,7 @@ def optimze1d(t, mu, w, params, bounds, mask):
 def construct_posterior_cov(t, w, params):
     """Make full posterior covariance matrix for hyperparameter tuning"""
     while True:
-        K, dK = kernel(t, params)
+        K, _ = kernel(t, params, mask=(0, 0, 0))
         try:
             L = cholesky(K, lower=True)
             break
@@ -147,16 +343,173 @@ def construct_posterior_cov(t, w, params):
     return S
 
 
+class PriorCache:
+    """LRU cache of prior factors bounded by memory"""
+
+    def __init__(self, maxbytes=2 ** 28):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.factors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, length, omega, sigma, rank, jitter=0.0, tol=None):
+        """Scaled Cholesky factors of squared exponential priors
+        Without tolerance, factors are exact if length <= rank, incomplete otherwise.
+        With tolerance, the rank of every factor is the smallest meeting it, up to rank.
+        The exact factor is used instead where that rank exceeds half of the length.
+        The factors of missing hyperparameters are made in one batch.
+        The returned arrays are shared and read-only.
+        :param omega: array of omegas
+        :param sigma: array of sigmas
+        :param jitter: diagonal added to the exact priors
+        :param tol: target mean residual variance of the incomplete factors
+        :return: list of (length, rank of the latent) factors
+        """
+        length, rank, jitter = int(length), int(rank), float(jitter)
+
+        if length <= rank and tol is None:
+            return self.exact(length, omega, sigma, jitter)
+
+        tol = 1e-6 if tol is None else float(tol)
+        keys = [(length, float(o), float(s), rank, tol) for o, s in zip(omega, sigma)]
+
+        def make(missing):
+            factors = ichol_gauss(length, [key[1] for key in missing], rank, tol=tol)
+            factors *= np.array([key[2] for key in missing])[:, np.newaxis, np.newaxis]
+            # drop the columns after the stop
+            return [
+                np.ascontiguousarray(
+                    G[:, : max(np.count_nonzero(np.any(G, axis=0)), 1)]
+                )
+                for G in factors
+            ]
+
+        factors = self.lookup(keys, make)
+
+        if length <= rank:
+            # the direct solve is cheaper
+            wide = [l for l, G in enumerate(factors) if 2 * G.shape[1] > length]
+            exact = self.exact(
+                length, [omega[l] for l in wide], [sigma[l] for l in wide], jitter
+            )
+            for l, G in zip(wide, exact):
+                factors[l] = G
+
+        return factors
+
+    def exact(self, length, omega, sigma, jitter=0.0):
+        """Exact Cholesky factors of squared exponential priors plus jitter"""
+        length, jitter = int(length), float(jitter)
+        keys = [
+            ("exact", length, float(o), float(s), jitter) for o, s in zip(omega, sigma)
+        ]
+
+        def make(missing):
+            kernels = self.kernel(
+                length, [key[2] for key in missing], [key[3] for key in missing], jitter
+            )
+            return [cholesky(K, lower=True) for K in kernels]
+
+        return self.lookup(keys, make)
+
+    def precision(self, length, omega, sigma, jitter=0.0):
+        """Inverses of squared exponential covariance matrices plus jitter
+        :return: list of (length, length) matrices
+        """
+        length, jitter = int(length), float(jitter)
+        keys = [
+            ("precision", length, float(o), float(s), jitter)
+            for o, s in zip(omega, sigma)
+        ]
+
+        def make(missing):
+            factors = self.exact(
+                length, [key[2] for key in missing], [key[3] for key in missing], jitter
+            )
+            return [cho_solve((L, True), np.eye(length)) for L in factors]
+
+        return self.lookup(keys, make)
+
+    def kernel(self, length, omega, sigma, jitter=0.0):
+        """Squared exponential covariance matrices
+        :return: list of (length, length) matrices
+        """
+        length, jitter = int(length), float(jitter)
+        keys = [
+            ("kernel", length, float(o), float(s), jitter) for o, s in zip(omega, sigma)
+        ]
+
+        def make(missing):
+            return [
+                sqexpcov(length, key[2], key[3] ** 2) + jitter * np.eye(length)
+                for key in missing
+            ]
+
+        return self.lookup(keys, make)
+
+    def lookup(self, keys, make):
+        """Get cached arrays, the missing ones are made by make(missing keys)"""
+        missing = list(
+            OrderedDict.fromkeys(key for key in keys if key not in self.factors)
+        )
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        if missing:
+            for key, G in zip(missing, make(missing)):
+                G.flags.writeable = False
+                self.factors[key] = G
+                self.nbytes += G.nbytes
+
+        for key in keys:
+            self.factors.move_to_end(key)
+        factors = [self.factors[key] for key in keys]
+        self.evict()
+        return factors
+
+    def evict(self):
+        """Drop least recently used factors but the last until the cache fits"""
+        while self.nbytes > self.maxbytes and len(self.factors) > 1:
+            _, G = self.factors.popitem(last=False)
+            self.nbytes -= G.nbytes
+
+    def clear(self):
+        self.factors.clear()
+        self.nbytes = 0
+
+
+prior_cache = PriorCache()
+
+
 def make_cholesky(trials, params, config):
-    """Make incomplate Cholesky decomposition"""
+    """Make incomplate Cholesky decomposition
+    Trials no longer than the rank get the exact factor and inverse kernel with jitter.
+    If config["rank_tol"] is set, the rank is chosen per latent and length.
+    Factors of unchanged hyperparameters are taken from the cache.
+    """
     zdim = params["zdim"]
     rank = params["rank"]
     sigma = params["sigma"]
     omega = params["omega"]
+
+    prior_cache.maxbytes = config["cache_size"]
+    prior_cache.evict()
+
+    jitter = params["gp_noise"]
+    tol = config["rank_tol"]
+
     lengths = np.array([trial["y"].shape[0] for trial in trials])
     unique_lengths = np.unique(lengths)
+    params["cholesky"] = dict()
+    params["precision"] = dict()
     for t in unique_lengths:
-        params["cholesky"] = dict()
-        params["cholesky"][t] = np.array(
-            [ichol_gauss(t, omega[l], rank) * sigma[l] for l in range(zdim)]
-        )
+        prior = prior_cache.get(t, omega[:zdim], sigma[:zdim], rank, jitter, tol)
+        params["cholesky"][t] = prior
+
+        # exact priors are square, the E step factors the posterior precision directly
+        exact = [l for l in range(zdim) if prior[l].shape[1] == t]
+        if exact:
+            precisions = prior_cache.precision(t, omega[exact], sigma[exact], jitter)
+            params["precision"][t] = [None] * zdim
+            for l, P in zip(exact, precisions):
+                params["precision"][t][l] = P
@@ -18,7 +18,7 @@ def rectify(x):
     return x.clip(0, np.inf)
 
 
-def trunc_exp(x, bound=10):
+def trunc_exp(x, bound=10, out=None):
     """
     Truncated exp
 
@@ -27,12 +27,14 @@ def trunc_exp(x, bound=10):
     x : ndarray
     bound : double
         upper bound of x
+    out : ndarray, optional
+        array to store the result, may be x
     Returns
     -------
     ndarray
         exp(min(x, bound))
     """
-    return np.exp(np.minimum(x, bound))
+    return np.exp(np.minimum(x, bound, out=out), out=out)
 
 
 def lexp(x, c=0):
@@ -79,8 +81,8 @@ def ichol_gauss(n, omega, r, dt=1.0, tol=1e-6, check_rank=False):
     ----------
     n : int
         size of matrix
-    omega : double
-        1 / (2 * timescale^2)
+    omega : double or ndarray
+        1 / (2 * timescale^2), an array of omegas is factorized in one batch
     r : int
         rank
     dt : float
@@ -91,36 +93,50 @@ def ichol_gauss(n, omega, r, dt=1.0, tol=1e-6, check_rank=False):
     Returns
     -------
     ndarray
-        (n, r) matrix
-    """
-    # TODO: more effifient algorithm
-    x = np.arange(n) * dt
-    d = np.ones(n, dtype=float)
-    pvec = np.arange(n, dtype=int)  # pivot
+        (n, r) matrix, or (len(omega), n, r) for an array of omegas
+    """
+    omega = np.asarray(omega, dtype=float)
+    batch = omega.ndim > 0
+    omega = np.atleast_1d(omega)
+    m = omega.shape[0]
+
+    # the kernel is stationary on the grid, A[i, j] = c[|i - j|]
+    c = np.exp(-omega[:, np.newaxis] * (np.arange(n) * dt) ** 2)
+    index = np.arange(n)
+    rows = np.arange(m)
+
+    Gt = np.zeros((m, r, n), dtype=float)  # transposed for contiguous columns
+    d = np.ones((m, n), dtype=float)  # diagonal of residual, zero at pivots
+    pvec = np.zeros((m, min(r, n)), dtype=int)  # pivots
+    active = np.ones(m, dtype=bool)
     i = 0
-    G = np.zeros((n, r), dtype=float)  # preallocation
-    while i < r and np.sum(d[i:]) > tol * n:
+    while i < min(r, n):
+        active &= np.sum(d, axis=1) > tol * n
+        if not np.any(active):
+            break
+
+        jast = d.argmax(axis=1)  # pivot
+        g = np.sqrt(np.where(active, d[rows, jast], 1.0))
+        col = c[rows[:, np.newaxis], np.abs(index - jast[:, np.newaxis])]
         if i > 0:
-            jast = d[i:].argmax()
-            jast += i
-            pvec[[i, jast]] = pvec[[jast, i]]
-            G[[i, jast], : i + 1] = G[[jast, i], : i + 1]  # avoid copy
-        else:
-            jast = 0
+            col -= (Gt[rows, :i, jast][:, np.newaxis, :] @ Gt[:, :i, :])[:, 0, :]
+        col /= g[:, np.newaxis]
+        col[rows[:, np.newaxis], pvec[:, :i]] = 0
+        col[rows, jast] = g
+        col[~active] = 0
 
-        G[i, i] = np.sqrt(d[jast])
-        nextcol = np.exp(
-            -omega * (x[pvec[i + 1 :]] - x[pvec[i]]) ** 2
-        )  # compute next column
-        G[i + 1 :, i] = (nextcol - np.dot(G[i + 1 :, :i], G[i, :i])) / G[i, i]
-        d[i + 1 :] = 1 - np.sum(np.square(G[i + 1 :, : i + 1]), axis=1)
+        Gt[:, i, :] = col
+        d -= np.square(col)  # incremental update of the residual
+        pvec[:, i] = jast
+        d[rows[:, np.newaxis], pvec[:, : i + 1]] = 0
 
         i += 1
 
     if i == r and check_rank:
         warnings.warn("You might need to increase the rank of the decomposition.")
 
-    return G[pvec.argsort(), :]
+    G = np.ascontiguousarray(Gt.transpose(0, 2, 1))
+    return G if batch else G[0]
 
 
 def ichol(a, tol=1e-6):
@@ -0,0 +1,80 @@
+"""
+Online inference of latent factors
+
+The posterior is updated on a sliding window of the latest bins with fitted
+parameters. The window is warm started from the previous update and the
+exact window prior comes from the factor cache, so the cost of an update is
+bounded by the window regardless of how long the recording runs.
+"""
+import numpy as np
+
+from .core import infer_single_trial, prepare_posterior
+
+
+class OnlineFilter:
+    """Filtered latent factors of bins arriving one at a time or in chunks
+
+    :param params: fitted parameters
+    :param config: options of the fit
+    :param window: number of latest bins the posterior is updated on, config["window"]
+        by default
+    :param niter: maximum number of E step iterations per update
+    """
+
+    def __init__(self, params, config, window=None, niter=5):
+        self.params = dict(params)
+        self.config = dict(config, Eniter=niter, joint=False)
+        self.window = window or self.config["window"]
+
+        zdim = params["zdim"]
+        xdim = params["xdim"]
+        ydim = params["ydim"]
+        self.trial = {
+            "y": np.zeros((0, ydim)),
+            "x": np.zeros((0, xdim, ydim)),
+            "mu": np.zeros((0, zdim)),
+            "w": np.zeros((0, zdim)),
+            "v": np.zeros((0, zdim)),
+            "dmu": np.zeros((0, zdim)),
+        }
+
+    def update(self, y, x=None):
+        """Add bins and infer their latent factors
+        :param y: (bin, ydim) counts, or (ydim,) of a single bin
+        :param x: (bin, xdim, ydim) regressors, constant by default
+        :return: filtered mean and variance of the new bins, (bin, zdim) each
+        """
+        y = np.atleast_2d(y)
+        nbin = y.shape[0]
+        if x is None:
+            x = np.ones((nbin, self.params["xdim"], self.params["ydim"]))
+
+        if nbin > self.window:
+            # one window at a time
+            results = [
+                self.update(y[i : i + self.window], x[i : i + self.window])
+                for i in range(0, nbin, self.window)
+            ]
+            return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+        # the new bins start from the last mean
+        zdim = self.params["zdim"]
+        mu = self.trial["mu"][-1:] if self.trial["mu"].shape[0] else np.zeros((1, zdim))
+        new = {
+            "y": y,
+            "x": x,
+            "mu": np.repeat(mu, nbin, axis=0),
+            "w": np.zeros((nbin, zdim)),
+            "v": np.zeros((nbin, zdim)),
+            "dmu": np.zeros((nbin, zdim)),
+        }
+        trial = {
+            key: np.concatenate([self.trial[key], new[key]])[-self.window :]
+            for key in self.trial
+        }
+
+        prepare_posterior([trial], self.params, self.config)
+        infer_single_trial(trial, self.params, self.config)
+        self.trial = trial
+
+        return trial["mu"][-nbin:], trial["v"][-nbin:]
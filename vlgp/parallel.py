@@ -0,0 +1,223 @@
+"""
+Multiprocess E step on shared trial buffers
+
+The trial arrays are copied once into memory-mapped files that every worker
+maps. Workers update the posterior in place, so nothing but the loading, bias
+and the paths of the prior factors is sent per E step.
+"""
+import concurrent.futures
+import functools
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .trialset import TrialSet
+from .util import trial_slices
+
+SHARED_KEYS = ("y", "x", "mu", "w", "v", "dmu")
+PRIOR_KEYS = ("cholesky", "precision")  # params of prior factors by length
+OUTPUT_KEYS = ("mu", "w", "v", "dmu")  # keys written by the E step
+
+# state of a worker process, set by the initializer
+_worker = {}
+
+
+def _open(path, dtype, shape):
+    return np.asarray(np.memmap(path, dtype=dtype, mode="r+", shape=shape))
+
+
+def _init_worker(layout):
+    """Map the shared buffers and make trial views in a worker"""
+    buffers = {key: _open(*spec) for key, spec in layout["buffers"].items()}
+    _worker["trials"] = [
+        {key: buffer[s] for key, buffer in buffers.items()} for s in layout["slices"]
+    ]
+    _worker["priors"] = {}
+
+
+def _estep_worker(indices, params, config):
+    """Run the E step on a chunk of trials in a worker
+    :return: number of inner iterations of every trial
+    """
+    from .core import estep
+
+    # keep only the factors in use so that released files can be unmapped
+    cached = _worker["priors"]
+    priors = {}
+
+    def attach(spec):
+        if spec is None:
+            return None
+        if spec[0] not in priors:
+            priors[spec[0]] = cached[spec[0]] if spec[0] in cached else _open(*spec)
+        return priors[spec[0]]
+
+    params = dict(params)
+    for key in PRIOR_KEYS:
+        if key in params:
+            params[key] = {
+                length: [attach(spec) for spec in specs]
+                for length, specs in params[key].items()
+            }
+    _worker["priors"] = priors
+
+    trials = [_worker["trials"][i] for i in indices]
+    return estep(trials, params, dict(config, parallel=False))
+
+
+class TrialPool:
+    """Persistent process pool working on trials in shared memory
+
+    The trials are rebound to views of the shared buffers until the pool is
+    closed, then the results are copied back into the original arrays. A TrialSet
+    reads the shared buffers in the meantime.
+    Set TMPDIR to a tmpfs, e.g. /dev/shm, to keep the buffers off the disk.
+    """
+
+    def __init__(self, trials, config):
+        parallel = config["parallel"]
+        self.max_workers = None if parallel is True else int(parallel)
+        self.trials = trials
+        self.index = {id(trial): i for i, trial in enumerate(trials)}
+        self.path = tempfile.mkdtemp(prefix="vlgp-")
+
+        # an empty pool has no buffers and its E step returns at once
+        keys = [
+            key
+            for key in SHARED_KEYS
+            if len(trials) and all(key in trial for trial in trials)
+        ]
+        slices = trial_slices([trial["y"].shape[0] for trial in trials])
+        nbin = slices[-1].stop if slices else 0
+
+        self.originals = [{key: trial[key] for key in keys} for trial in trials]
+        buffers = {}
+        shared = {}
+        for key in keys:
+            first = np.asarray(trials[0][key])
+            dtype = functools.reduce(
+                np.promote_types, [trial[key].dtype for trial in trials]
+            )
+            spec = (
+                os.path.join(self.path, key + ".dat"),
+                dtype.str,
+                (nbin,) + first.shape[1:],
+            )
+            buffer = np.asarray(
+                np.memmap(spec[0], dtype=dtype, mode="w+", shape=spec[2])
+            )
+            for trial, s in zip(trials, slices):
+                buffer[s] = trial[key]
+                trial[key] = buffer[s]
+            buffers[key] = spec
+            shared[key] = buffer
+
+        # the buffers are laid out as those of a TrialSet
+        self.arrays = None
+        if isinstance(trials, TrialSet):
+            self.arrays = trials.arrays
+            trials.arrays = {key: shared[key] for key in self.arrays}
+
+        self.layout = {"buffers": buffers, "slices": slices}
+        self.published = {}  # id of factor -> (factor, file spec)
+        self.nprior = 0
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=_init_worker,
+            initargs=(self.layout,),
+        )
+        self.nworker = self.max_workers or os.cpu_count() or 1
+
+    def publish_prior(self, prior):
+        """Write prior factors that changed since the last E step
+        :param prior: {length: list of factors}, ranks may differ and entries be None
+        :return: {length: list of file specs}
+        """
+        specs = {}
+        for length, factors in prior.items():
+            specs[length] = []
+            for G in factors:
+                if G is None:
+                    specs[length].append(None)
+                    continue
+                key = id(G)  # the published factor is kept alive
+                if key not in self.published:
+                    self.nprior += 1
+                    array = np.asarray(G)
+                    spec = (
+                        os.path.join(self.path, "prior-{}.dat".format(self.nprior)),
+                        array.dtype.str,
+                        array.shape,
+                    )
+                    out = np.memmap(spec[0], array.dtype, "w+", shape=array.shape)
+                    out[:] = array
+                    self.published[key] = (G, spec)
+                specs[length].append(self.published[key][1])
+        return specs
+
+    def release_prior(self, params):
+        """Remove the files of factors no longer in use"""
+        used = {
+            id(G)
+            for key in PRIOR_KEYS
+            for factors in params.get(key, {}).values()
+            for G in factors
+        }
+        for key in list(self.published):
+            if key not in used:
+                os.remove(self.published.pop(key)[1][0])
+
+    def estep(self, params, config, trials=None):
+        """Update trials in parallel
+        :param trials: subset of the trials of the pool, all by default
+        :return: number of inner iterations of every trial
+        """
+        if trials is None:
+            indices = np.arange(len(self.trials))
+        else:
+            indices = np.array([self.index[id(trial)] for trial in trials], dtype=int)
+        ntrial = len(indices)
+        if ntrial == 0:
+            return np.zeros(0, dtype=int)
+
+        shared_params = {k: v for k, v in params.items() if k != "initial"}
+        self.release_prior(params)
+        for key in PRIOR_KEYS:
+            if key in params:
+                shared_params[key] = self.publish_prior(params[key])
+        shared_config = {
+            k: v for k, v in config.items() if k not in ("callbacks", "runtime")
+        }
+
+        # a few chunks per worker for load balance
+        chunks = np.array_split(indices, min(ntrial, 4 * self.nworker))
+        futures = [
+            self.executor.submit(_estep_worker, chunk, shared_params, shared_config)
+            for chunk in chunks
+        ]
+        # raise errors of workers
+        return np.concatenate([future.result() for future in futures]).astype(int)
+
+    def close(self):
+        """Shut down the workers and copy the results back"""
+        self.executor.shutdown(wait=True)
+        for trial, originals in zip(self.trials, self.originals):
+            for key, original in originals.items():
+                if key not in OUTPUT_KEYS:
+                    trial[key] = original
+                elif isinstance(original, np.ndarray) and original.flags.writeable:
+                    original[...] = trial[key]
+                    trial[key] = original
+                else:
+                    trial[key] = np.array(trial[key])
+        if self.arrays is not None:
+            self.trials.arrays = self.arrays
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -10,14 +10,23 @@ def initialize(trials, params, config):
     xdim = params["xdim"]
 
     # TODO: use only a subsample of trials?
-    y = np.concatenate([trial["y"] for trial in trials], axis=0)
-    subsample = np.random.choice(y.shape[0], max(y.shape[0] // 10, 50))
-    ydim = y.shape[-1]
+    # the subsample is gathered from the trials without concatenating them
+    lengths = np.array([trial["y"].shape[0] for trial in trials])
+    offsets = np.cumsum(lengths) - lengths
+    nbin = np.sum(lengths)
+    subsample = np.random.choice(nbin, max(nbin // 10, 50))
+    ydim = trials[0]["y"].shape[-1]
+    owner = np.searchsorted(offsets, subsample, side="right") - 1
+    y = np.empty((subsample.size, ydim), dtype=trials[0]["y"].dtype)
+    for i in np.unique(owner):
+        y[owner == i] = trials[i]["y"][subsample[owner == i] - offsets[i]]
+
     fa = FactorAnalysis(n_components=zdim, random_state=0)
-    z = fa.fit_transform(y[subsample, :])
+    z = fa.fit_transform(y)
     a = fa.components_
-    b = np.log(np.maximum(np.mean(y, axis=0, keepdims=True), config["eps"]))
-    noise = np.var(y[subsample, :] - z @ a, ddof=0, axis=0)
+    ysum = sum(np.sum(trial["y"], axis=0, keepdims=True) for trial in trials)
+    b = np.log(np.maximum(ysum / nbin, config["eps"]))
+    noise = np.var(y - z @ a, ddof=0, axis=0)
 
     # stupid way of update
     # two cases
@@ -68,7 +77,7 @@ def get_params(trials, zdim, **kwargs):
         "noise": kwargs.get("noise", None),
         "sigma": kwargs.get("sigma", np.full(zdim, fill_value=1.0)),
         "omega": kwargs.get("omega", np.full(zdim, fill_value=kwargs["omega_bound"][1])),
-        "rank": 50,  # TODO: consider merge with window in config
+        "rank": 50,  # maximum rank of prior, TODO: consider merge with window in config
         "gp_noise": 1e-4,
         "dt": 1,
         "likelihood": lik,
@@ -91,6 +100,16 @@ def get_config(**kwargs):
         "Eniter": 25,  # number of interations inside E step
         "Mniter": 25,  # number of interations inside M step
         "Hstep": True,  # learn hyperparameters
+        "Hsigma": False,  # learn sigma along with omega
+        "Hevery": 1,  # run H step every so many iterations
+        "Htol": None,  # double the H step interval while log omega moves less than this
+        "Hsample": 0,  # number of trials sampled for H step, 0 uses all
+        "Hseed": None,  # seed of the sample
+        "minibatch": 0,  # trials per iteration of stochastic vEM, 0 runs full vEM
+        "epochs": 10,  # passes over the trials in stochastic vEM
+        "rate_delay": 1.0,  # step size (rate_delay + iteration) ** -rate_decay
+        "rate_decay": 0.6,  # in (0.5, 1] for convergence
+        "seed": None,  # seed of the minibatches
         "da_bound": 5.0,  # clip the update to loading matrix
         "db_bound": 5.0,  # clip the update to bias
         "dmu_bound": 5.0,  # clip the update to posterior mean
@@ -98,7 +117,18 @@ def get_config(**kwargs):
         "window": 50,  # window size that the trials are cut into
         "saving_interval": 60 * 30,  # time interval of saving snapshots
         "callbacks": [],  # functions are called every iteration
-        "parallel": False,
+        "rank_tol": None,  # target error of the prior, adapts the rank per latent
+        "cache_size": 2 ** 28,  # bytes of cached prior factors
+        "Mchunk": 0,  # number of time bins M step reads at once, 0 reads all trials
+        "Erecheck": 0,  # iterations between updates of converged trials, 0 updates all
+        "joint": False,  # update all latents in one batched solve in E step
+        "squarem": False,  # extrapolate (mu, a, b) from every three vEM iterations
+        "Echunk": 0,  # chunk length of longer trials in inference, 0 for whole
+        "Eoverlap": None,  # bins shared by consecutive chunks, a quarter by default
+        "Eblock": 64,  # number of chunks inferred at once, bounds the memory
+        "Epath": None,  # directory that long trials are written to, in memory if None
+        "batch": 0,  # equal-length trials stacked in E step, 0 for one by one
+        "parallel": False,  # number of worker processes, True for all cores
     }
 
     updates = {k: v for k, v in kwargs.items() if k in config}  # discard unknown args
@@ -0,0 +1,108 @@
+"""
+Contiguous storage of trials
+
+A TrialSet keeps each array of its trials in one buffer along time, indexed by
+the offsets of the trials. The trials are still the original dicts with their
+arrays rebound to views of the buffers, so the code written for lists of
+trials works on either. Segments cut from them without overlaps share the
+buffers, overlapping ones are stored in a TrialSet of their own.
+"""
+import numpy as np
+
+TRIAL_KEYS = ("y", "x", "mu", "w", "v", "dmu")
+
+
+class TrialSet:
+    """Sequence of trials stored contiguously
+
+    :param trials: iterable of trials, their arrays are copied into the buffers
+    :param keys: keys of arrays to store, among those every trial has
+    """
+
+    def __init__(self, trials, keys=TRIAL_KEYS):
+        trials = list(trials)
+        keys = [
+            key
+            for key in keys
+            if trials and all(trial.get(key) is not None for trial in trials)
+        ]
+        arrays = {
+            key: np.concatenate([trial[key] for trial in trials], axis=0)
+            for key in keys
+        }
+        lengths = [trial["y"].shape[0] for trial in trials]
+        self._bind(trials, arrays, lengths)
+
+    @classmethod
+    def tile(cls, trials, arrays):
+        """TrialSet of trials that tile the given buffers in order, nothing is copied"""
+        trialset = cls.__new__(cls)
+        trialset._bind(trials, arrays, [trial["y"].shape[0] for trial in trials])
+        return trialset
+
+    def _bind(self, trials, arrays, lengths):
+        self.trials = trials
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + list(lengths))
+        for trial, s in zip(trials, self.slices):
+            for key, array in arrays.items():
+                trial[key] = array[s]
+
+    @property
+    def slices(self):
+        return [
+            np.s_[start:stop]
+            for start, stop in zip(self.offsets[:-1], self.offsets[1:])
+        ]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.trials)
+
+    def __iter__(self):
+        return iter(self.trials)
+
+    def __getitem__(self, index):
+        """A trial, a TrialSet sharing the buffers for a range, or a list otherwise"""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                view = TrialSet.__new__(TrialSet)
+                view.trials = self.trials[start:stop]
+                lo, hi = self.offsets[start], self.offsets[stop]
+                view.arrays = {key: array[lo:hi] for key, array in self.arrays.items()}
+                view.offsets = self.offsets[start : stop + 1] - lo
+                return view
+            return self.trials[index]
+        if isinstance(index, (list, np.ndarray)):
+            return [self.trials[i] for i in index]
+        return self.trials[index]
+
+    def concat(self, key):
+        """Array of all trials along time, without copy if it is stored"""
+        if key in self.arrays:
+            return self.arrays[key]
+        return np.concatenate([trial[key] for trial in self.trials], axis=0)
+
+    def stack(self, key):
+        """(trial, time, ...) array of trials of equal length, a view if it is stored"""
+        lengths = self.lengths
+        if key in self.arrays and len(lengths) and np.all(lengths == lengths[0]):
+            array = self.arrays[key]
+            return array.reshape((len(lengths), lengths[0]) + array.shape[1:])
+        return np.stack([trial[key] for trial in self.trials])
+
+    def __getstate__(self):
+        # the views are made again from the buffers
+        trials = [
+            {k: v for k, v in trial.items() if k not in self.arrays}
+            for trial in self.trials
+        ]
+        return {"trials": trials, "arrays": self.arrays, "lengths": self.lengths}
+
+    def __setstate__(self, state):
+        self._bind(state["trials"], state["arrays"], state["lengths"])
@@ -15,6 +15,7 @@ from scipy.linalg import svd, lstsq, toeplitz, solve
 from scipy.ndimage.filters import gaussian_filter1d
 
 from .math import ichol_gauss
+from .trialset import TrialSet
 
 logger = logging.getLogger(__name__)
 
@@ -52,7 +53,7 @@ def sqexpcov(n: int, w: float, var: float = 1.0):
 
     # i, j = meshgrid(arange(n), arange(n))
     # return var * exp(- w * (i - j) ** 2)
-    return var * exp(-w * toeplitz(arange(n)))
+    return var * exp(-w * toeplitz(arange(n)) ** 2)
 
 
 def promax(x, m=4):
@@ -192,17 +193,19 @@ def save(result, path, ext="npy"):
         np.savez(path, **result)
 
 
-def load(path):
-    """Load result from file"""
+def load(path, allow_pickle=False):
+    """Load result from file
+    :param allow_pickle: allow pickled objects, only for files from a trusted source
+    """
     path = pathlib.Path(path)
     if not path.exists():
         raise FileNotFoundError(path.as_posix())
 
     if path.suffix == ".npy":
-        rez = np.load(path)
+        rez = np.load(path, allow_pickle=allow_pickle)
         rez = rez[()]
     elif path.suffix == ".npz":
-        rez = np.load(path)
+        rez = np.load(path, allow_pickle=allow_pickle)
         rez = {**rez}
     else:
         raise NotImplementedError("unknown file type {}".format(path.suffix))
@@ -332,6 +335,51 @@ def trial_slices(trial_lengths: List[int]):
     return slices
 
 
+def chunk_trials(trials, size):
+    """Group consecutive trials into chunks of at most size time bins
+    A trial longer than size makes a chunk by itself.
+    :param size: maximum number of time bins, 0 puts all trials in one chunk
+    :return: list of slices of trials, a TrialSet gives views
+    """
+    if not size:
+        return [trials] if len(trials) else []
+
+    starts = []
+    nbin = 0
+    for i, trial in enumerate(trials):
+        length = trial["y"].shape[0]
+        if starts and nbin + length <= size:
+            nbin += length
+        else:
+            starts.append(i)
+            nbin = length
+    stops = starts[1:] + [len(trials)]
+    return [trials[start:stop] for start, stop in zip(starts, stops)]
+
+
+def concat_trials(trials, key):
+    """Concatenate an array of trials along time, no copy of one trial or a TrialSet"""
+    if isinstance(trials, TrialSet):
+        return trials.concat(key)
+    if len(trials) == 1:
+        return trials[0][key]
+    return np.concatenate([trial[key] for trial in trials], axis=0)
+
+
+def stack_trials(trials, key):
+    """Stack an array of trials of equal length, a TrialSet is not copied"""
+    if isinstance(trials, TrialSet):
+        return trials.stack(key)
+    return np.stack([trial[key] for trial in trials])
+
+
+def norm_trials(trials, key):
+    """Frobenius norm of an array of all trials without concatenating them"""
+    if isinstance(trials, TrialSet) and key in trials.arrays:
+        return np.linalg.norm(trials.arrays[key])
+    return np.sqrt(sum(np.sum(np.square(trial[key])) for trial in trials))
+
+
 def auto(y, lag):
     """
 
@@ -457,25 +505,33 @@ def clip(a, lbound, ubound=None):
 
 
 def cut_trials(trials, params, config):
-    """Cut all trials"""
+    """Cut all trials into a TrialSet of segments
+    The segments of a TrialSet without overlaps tile its buffers and share them.
+    Otherwise the segments are copied into buffers of their own once, and
+    blend_segments writes them back into their trials.
+    """
     window = config["window"]
     if window and window is not None:
-        return np.concatenate(
-            [cut_trial(trial, window) for trial in trials]
-        )  # concatenate segments
+        segments = [segment for trial in trials for segment in cut_trial(trial, window)]
+        tiled = not any(segment["copy"] for segment in segments)
+        if isinstance(trials, TrialSet) and tiled:
+            return TrialSet.tile(segments, trials.arrays)
+        for segment in segments:
+            segment["copy"] = True
+        return TrialSet(segments)
     else:
         return trials
 
 
 def cut_trial(trial, window: int):
-    """Cut a trial into small segments"""
+    """Cut a trial into small segments
+    The segments are views of the trial, except the overlapping ones that get
+    their own copies and are merged back by blend_segments.
+    """
     import math
 
     y = trial["y"]
     x = trial["x"]
-    mu = trial["mu"]
-    w = trial["w"]
-    v = trial["v"]
 
     length = y.shape[0]
 
@@ -494,13 +550,59 @@ def cut_trial(trial, window: int):
     )
     start -= offset
     slices = [np.s_[s : s + window] for s in start]
-    segments = [
-        {"y": y[s, :], "x": x[s, ...], "mu": mu[s, :], "w": w[s, :], "v": v[s, :]}
-        for s in slices
-    ]
+    stop = start + window
+    overlapping = np.zeros(num_segments, dtype=bool)
+    overlapping[:-1] |= stop[:-1] > start[1:]
+    overlapping[1:] |= stop[:-1] > start[1:]
+
+    segments = []
+    for s, o in zip(slices, overlapping):
+        copy = np.copy if o else np.asarray
+        segment = {
+            "y": y[s, :],
+            "x": x[s, ...],
+            "parent": trial,
+            "start": s.start,
+            "overlap": o,
+            "copy": o,  # not a view of the trial
+        }
+        for key in ("mu", "w", "v", "dmu"):
+            if key in trial:
+                segment[key] = copy(trial[key][s, :])
+        segments.append(segment)
     return segments
 
 
+def blend_segments(segments, keys=("mu", "w", "v")):
+    """Average the segments that are copies and write them back into their trials"""
+    groups = {}
+    for segment in segments:
+        if segment.get("copy"):
+            parent = segment["parent"]
+            groups.setdefault(id(parent), (parent, []))[1].append(segment)
+
+    for parent, group in groups.values():
+        lo = min(segment["start"] for segment in group)
+        hi = max(segment["start"] + segment["y"].shape[0] for segment in group)
+        spans = [
+            np.s_[segment["start"] - lo : segment["start"] - lo + segment["y"].shape[0]]
+            for segment in group
+        ]
+        count = np.zeros(hi - lo)
+        for s in spans:
+            count[s] += 1
+        covered = count > 0
+        for key in keys:
+            total = np.zeros((hi - lo,) + parent[key].shape[1:])
+            for segment, s in zip(group, spans):
+                total[s] += segment[key]
+            blended = parent[key][lo:hi]
+            blended[covered] = total[covered] / count[covered, np.newaxis]
+            for segment, s in zip(group, spans):
+                if segment["overlap"]:
+                    segment[key][:] = blended[s]
+
+
 def check_random_state(seed):
     """Turn seed into a np.random.RandomState instance"""
     if seed is None or seed is np.random: